@@ -6,14 +6,79 @@ account or a connected account.
 """
 
 import stripe
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from stripe_utils import install_http_client, retrieve_payment
 
 # Set your Stripe API key
 stripe.api_key = 'sk_live_...'
 
+# Share one rate-limited connection pool between all threads
+install_http_client()
+
+# How many connected accounts to probe at the same time
+MAX_WORKERS = 20
+# How many of the busiest accounts to try one by one before probing the rest
+TOP_ACCOUNTS = 3
+# How many payments to look up at the same time
+PAYMENT_WORKERS = 16
+
+# payment_id -> result dict, so repeated IDs in a batch skip the probes
+PID_CACHE_SIZE = 4096
+_pid_cache = OrderedDict()
+_pid_cache_lock = threading.Lock()
+
+# Connected accounts are listed once and reused for every payment
+ACCOUNTS_TTL = 600  # Seconds before the account list is fetched again
+_connected_accounts = None
+_connected_accounts_fetched_at = 0.0
+_connected_accounts_lock = threading.Lock()
+
+# account_id -> payments found there; busiest accounts get probed first
+_account_hit_counts = Counter()
+
+
+def _get_connected_accounts():
+    """List all connected accounts (every page), cached for ACCOUNTS_TTL seconds"""
+    global _connected_accounts, _connected_accounts_fetched_at
+    with _connected_accounts_lock:
+        if (_connected_accounts is None
+                or time.monotonic() - _connected_accounts_fetched_at > ACCOUNTS_TTL):
+            _connected_accounts = list(stripe.Account.list(limit=100).auto_paging_iter())
+            _connected_accounts_fetched_at = time.monotonic()
+        return _connected_accounts
+
+
+def _probe(payment_id, account):
+    """
+    Try to retrieve a payment from one connected account.
+    
+    Returns:
+        tuple: (account, payment) if the account owns the payment, else None
+    """
+    try:
+        # THE KEY: Use stripe_account parameter to search specific account
+        # (retrieve_payment retries rate limits and network errors)
+        payment = retrieve_payment(
+            payment_id,
+            stripe_account=account.id  # THIS IS THE CRITICAL PARAMETER
+        )
+        return account, payment
+    except (stripe.error.InvalidRequestError, stripe.error.PermissionError):
+        # Payment not in this account (or no access to it)
+        return None
+
+
 def find_payment_account(payment_id):
     """
     Determines which Stripe account owns a payment.
     
+    Results are memoized per payment ID (LRU, PID_CACHE_SIZE entries), so
+    a payment that appears twice in a batch is only looked up once.
+    
     Args:
         payment_id (str): Stripe PaymentIntent ID (e.g., "pi_3RuF3D...")
     
@@ -26,13 +91,28 @@ def find_payment_account(payment_id):
             'payment': PaymentIntent object or None
         }
     """
+    with _pid_cache_lock:
+        if payment_id in _pid_cache:
+            _pid_cache.move_to_end(payment_id)
+            return _pid_cache[payment_id]
+    
+    result = _lookup_payment_account(payment_id)
+    
+    # Only remember payments that were found, the next call should try again
+    if result['found']:
+        with _pid_cache_lock:
+            _pid_cache[payment_id] = result
+            if len(_pid_cache) > PID_CACHE_SIZE:
+                _pid_cache.popitem(last=False)
+    return result
+
+
+def _lookup_payment_account(payment_id):
+    """Uncached lookup behind find_payment_account()"""
     
     # STEP 1: Try platform account first (no stripe_account parameter)
     try:
-        payment = stripe.PaymentIntent.retrieve(
-            payment_id,
-            expand=['latest_charge.balance_transaction']
-        )
+        payment = retrieve_payment(payment_id)
         
         return {
             'found': True,
@@ -47,7 +127,7 @@ def find_payment_account(payment_id):
     
     # STEP 2: Get all connected accounts
     try:
-        connected_accounts = stripe.Account.list(limit=100)
+        connected_accounts = _get_connected_accounts()
     except Exception as e:
         print(f"Error listing accounts: {e}")
         return {
@@ -58,38 +138,46 @@ def find_payment_account(payment_id):
             'payment': None
         }
     
-    # STEP 3: Try each connected account
-    for account in connected_accounts.data:
+    # STEP 3: Try the busiest accounts one by one, then all others in parallel
+    by_hits = sorted(connected_accounts, key=lambda a: -_account_hit_counts[a.id])
+    top = [a for a in by_hits[:TOP_ACCOUNTS] if _account_hit_counts[a.id] > 0]
+    found = None
+    for account in top:
+        found = _probe(payment_id, account)
+        if found is not None:
+            break
+    
+    if found is None:
+        executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
         try:
-            # THE KEY: Use stripe_account parameter to search specific account
-            payment = stripe.PaymentIntent.retrieve(
-                payment_id,
-                stripe_account=account.id,  # THIS IS THE CRITICAL PARAMETER
-                expand=['latest_charge.balance_transaction']
-            )
-            
-            # Found it!
-            account_name = "Unknown"
-            if hasattr(account, 'business_profile') and account.business_profile:
-                account_name = account.business_profile.name or account.email
-            elif hasattr(account, 'email'):
-                account_name = account.email
-            
-            return {
-                'found': True,
-                'account_type': 'connected',
-                'account_id': account.id,
-                'account_name': account_name,
-                'payment': payment
-            }
+            futures = [executor.submit(_probe, payment_id, account)
+                       for account in by_hits[len(top):]]
             
-        except stripe.error.InvalidRequestError:
-            # Payment not in this account, try next one
-            continue
-        except Exception as e:
-            # Unexpected error, log and continue
-            print(f"Error checking account {account.id}: {e}")
-            continue
+            for future in as_completed(futures):
+                found = future.result()
+                if found is not None:
+                    break
+        finally:
+            # Skip the probes that have not started yet, once found or on an error
+            executor.shutdown(cancel_futures=True)
+    
+    if found is not None:
+        # Found it!
+        account, payment = found
+        _account_hit_counts[account.id] += 1
+        business_profile = getattr(account, 'business_profile', None)
+        if business_profile:
+            account_name = business_profile.name or account.email
+        else:
+            account_name = getattr(account, 'email', "Unknown")
+        
+        return {
+            'found': True,
+            'account_type': 'connected',
+            'account_id': account.id,
+            'account_name': account_name,
+            'payment': payment
+        }
     
     # STEP 4: Not found in any account
     return {
@@ -145,11 +233,13 @@ def process_multiple_payments(payment_ids):
         'not_found': []
     }
     
-    for payment_id in payment_ids:
+    # Look up payments in parallel, results come back in input order
+    with ThreadPoolExecutor(max_workers=PAYMENT_WORKERS) as executor:
+        lookups = list(executor.map(find_payment_account, payment_ids))
+    
+    for payment_id, result in zip(payment_ids, lookups):
         print(f"Checking {payment_id}...", end=' ')
         
-        result = find_payment_account(payment_id)
-        
         if result['account_type'] == 'platform':
             results['platform'].append(result)
             print(f"✓ Platform - ${result['payment'].amount/100:.2f}")
@@ -206,6 +296,7 @@ When calling stripe.PaymentIntent.retrieve():
 
 This is how we determine which account owns a payment:
 - Try platform first
-- If not found, try each connected account
+- If not found, try the connected accounts (in parallel, since each
+  retrieve is just a blocking HTTP round-trip)
 - The account where retrieve() succeeds is the owner
 """
@@ -6,13 +6,39 @@ Check which Stripe account owns each payment
 import stripe
 import os
 import csv
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 import pytz
 
+# PaymentIntents are always fetched fresh here (read_cache=False) so the
+# reported status and payout state are current; they are still written to
+# the cache for update_excel_with_bank_info.py
+from stripe_utils import (bt_cache, install_http_client, retrieve_payment, retry_stripe,
+                          sweep_payment_cache)
+
 # Configuration
 STRIPE_API_KEY = os.environ.get('STRIPE_SECRET_KEY', '')
 PAYMENT_IDS_FILE = 'payment_ids.txt'
 OUTPUT_FILE = 'payment_account_mapping.csv'
+FIELDNAMES = ['payment_id', 'account_id', 'account_name', 'customer_name', 'event_name',
+              'amount', 'currency', 'status', 'transaction_date_est', 'payout_status', 'payout_date']
+MAX_WORKERS = 20  # Connected accounts probed at the same time
+TOP_ACCOUNTS = 3  # Busiest accounts tried one by one before probing the rest
+# Platform payments created in this many days are listed up front, so payments
+# that live on a connected account don't waste a platform lookup first
+PLATFORM_LOOKBACK_DAYS = int(os.environ.get('PLATFORM_LOOKBACK_DAYS', '90'))
+PAYMENT_WORKERS = 16  # Payments looked up at the same time
+CACHE_TTL = 3600  # Seconds to trust cached customer names
+
+# (stripe_account, customer_id) -> (name, cached_at)
+_customer_cache = {}
+
+# account_id -> payments found there this run; a few accounts own most payments,
+# so probing the busiest accounts first finds payments sooner
+_account_hit_counts = Counter()
 
 # Timezone
 EST = pytz.timezone('America/New_York')
@@ -23,33 +49,78 @@ def setup_stripe():
         print("ERROR: STRIPE_SECRET_KEY environment variable not set!")
         exit(1)
     stripe.api_key = STRIPE_API_KEY
+    install_http_client()
+    sweep_payment_cache()
 
 def load_payment_ids(filename):
-    """Load payment IDs from file"""
-    payment_ids = []
+    """Load payment IDs from file, dropping duplicates (first occurrence wins)"""
     with open(filename, 'r') as f:
-        for line in f:
-            pid = line.strip()
-            if pid and pid != 'N/A':
-                payment_ids.append(pid)
+        raw_ids = [pid for pid in (line.strip() for line in f) if pid and pid != 'N/A']
+    payment_ids = list(dict.fromkeys(raw_ids))
+    if len(payment_ids) < len(raw_ids):
+        print(f"Deduplicated {len(raw_ids) - len(payment_ids)} payment IDs")
     return payment_ids
 
+def load_existing_results(filename):
+    """Load the rows an interrupted earlier run already wrote to the output CSV"""
+    try:
+        with open(filename, 'r', newline='') as f:
+            return list(csv.DictReader(f))
+    except FileNotFoundError:
+        return []
+
 def check_payment_on_connected_account(payment_id, connected_account_id):
     """Try to retrieve payment from a connected account"""
     try:
-        payment = stripe.PaymentIntent.retrieve(
-            payment_id,
-            stripe_account=connected_account_id,
-            expand=['latest_charge.balance_transaction']
-        )
+        payment = retrieve_payment(payment_id, stripe_account=connected_account_id, read_cache=False)
         return True, payment
-    except:
+    except (stripe.error.InvalidRequestError, stripe.error.PermissionError):
+        # Not in this account (or no access to it)
         return False, None
 
+def find_on_connected_accounts(payment_id, connected_accounts):
+    """
+    Find the connected account that owns a payment, return (account, payment).
+    
+    The TOP_ACCOUNTS busiest accounts so far are tried one at a time, as they
+    usually own the payment; only if they don't are the others probed in parallel.
+    """
+    by_hits = sorted(connected_accounts, key=lambda a: -_account_hit_counts[a['id']])
+    top = [a for a in by_hits[:TOP_ACCOUNTS] if _account_hit_counts[a['id']] > 0]
+    for account in top:
+        success, payment = check_payment_on_connected_account(payment_id, account['id'])
+        if success:
+            _account_hit_counts[account['id']] += 1
+            return account, payment
+    
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    try:
+        futures = {
+            executor.submit(check_payment_on_connected_account, payment_id, account['id']): account
+            for account in by_hits[len(top):]
+        }
+        for future in as_completed(futures):
+            success, payment = future.result()
+            if success:
+                account = futures[future]
+                _account_hit_counts[account['id']] += 1
+                return account, payment
+    finally:
+        # Skip the probes that have not started yet, once found or on an error
+        executor.shutdown(cancel_futures=True)
+    return None, None
+
+@retry_stripe
 def get_customer_name(customer_id, stripe_account=None):
-    """Get customer name from Stripe"""
+    """Get customer name from Stripe (cached, the same customer often buys several tickets)"""
     if not customer_id:
         return ''
+    key = (stripe_account, customer_id)
+    cached = _customer_cache.get(key)
+    if cached and time.monotonic() - cached[1] < CACHE_TTL:
+        return cached[0]
+    
+    name = ''
     try:
         if stripe_account:
             customer = stripe.Customer.retrieve(customer_id, stripe_account=stripe_account)
@@ -57,13 +128,13 @@ def get_customer_name(customer_id, stripe_account=None):
             customer = stripe.Customer.retrieve(customer_id)
         
         # Try to get name from customer object
-        if hasattr(customer, 'name') and customer.name:
-            return customer.name
-        elif hasattr(customer, 'email') and customer.email:
-            return customer.email
-        return ''
-    except:
-        return ''
+        name = getattr(customer, 'name', None) or getattr(customer, 'email', None) or ''
+    except (stripe.error.InvalidRequestError, stripe.error.PermissionError):
+        # Deleted or unknown customer, or no access to it
+        pass
+    
+    _customer_cache[key] = (name, time.monotonic())
+    return name
 
 def get_payout_status(balance_transaction, stripe_account=None):
     """Check if the payment has been paid out to the bank"""
@@ -74,13 +145,20 @@ def get_payout_status(balance_transaction, stripe_account=None):
         # Balance transaction should already be expanded
         bt = balance_transaction
         
+        # Payout found by update_excel_with_bank_info.py, once it has reached the bank
+        cached = bt_cache.get(bt.id)
+        if cached and cached[3] == 'paid':
+            deposit_date = cached[2]
+            return f'Paid Out ({deposit_date})', deposit_date
+        
         # Check status
-        if hasattr(bt, 'status'):
-            status = bt.status  # 'available' or 'pending'
+        status = getattr(bt, 'status', None)  # 'available' or 'pending'
+        if status is not None:
             available_date = ''
             
-            if hasattr(bt, 'available_on') and bt.available_on:
-                available_date = datetime.fromtimestamp(bt.available_on, EST).strftime('%Y-%m-%d')
+            available_on = getattr(bt, 'available_on', None)
+            if available_on:
+                available_date = datetime.fromtimestamp(available_on, EST).strftime('%Y-%m-%d')
             
             if status == 'available':
                 return f'Available ({available_date})', available_date
@@ -91,6 +169,121 @@ def get_payout_status(balance_transaction, stripe_account=None):
     except Exception as e:
         return 'Unknown', ''
 
+def fill_payment_details(result, payment, stripe_account=None):
+    """Copy amount, date, customer, event and payout info of a payment into result"""
+    result['amount'] = payment.amount / 100
+    result['currency'] = payment.currency.upper()
+    result['status'] = payment.status
+    
+    # Get transaction date in EST
+    created = getattr(payment, 'created', None)
+    if created is not None:
+        created_utc = datetime.fromtimestamp(created, pytz.UTC)
+        created_est = created_utc.astimezone(EST)
+        result['transaction_date_est'] = created_est.strftime('%Y-%m-%d %H:%M:%S %Z')
+    
+    # Get customer name
+    customer = getattr(payment, 'customer', None)
+    if customer:
+        result['customer_name'] = get_customer_name(customer, stripe_account=stripe_account)
+    
+    # Get event name from metadata
+    metadata = getattr(payment, 'metadata', None)
+    if metadata:
+        # StripeObject is not a dict (no .get) since stripe-python 15
+        metadata = metadata.to_dict()
+        result['event_name'] = metadata.get('event', metadata.get('event_name', metadata.get('Event Name', '')))
+    
+    # Get payout status
+    charge = getattr(payment, 'latest_charge', None)
+    if charge:
+        balance_transaction = getattr(charge, 'balance_transaction', None)
+        if balance_transaction:
+            payout_status, payout_date = get_payout_status(balance_transaction, stripe_account=stripe_account)
+            result['payout_status'] = payout_status
+            result['payout_date'] = payout_date
+
+@retry_stripe
+def list_platform_payments_page(since, starting_after=None):
+    """One page of platform payments created since `since`, retried on its own"""
+    return stripe.PaymentIntent.list(limit=100, created={'gte': since}, starting_after=starting_after)
+
+def load_platform_payment_ids(days, max_pages):
+    """
+    List the IDs of all platform payments created in the last `days` days.
+    
+    Returns None if that takes more than max_pages list calls, i.e. costs more
+    than the platform lookups it would save.
+    """
+    since = int(time.time()) - days * 86400
+    platform_ids = set()
+    starting_after = None
+    for _ in range(max_pages):
+        page = list_platform_payments_page(since, starting_after)
+        platform_ids.update(payment.id for payment in page.data)
+        if not page.has_more or not page.data:
+            return platform_ids
+        starting_after = page.data[-1].id
+    return None
+
+def check_platform(payment_id, result):
+    """Try the platform account, fill result and return the progress message if found"""
+    try:
+        payment = retrieve_payment(payment_id, read_cache=False)
+    except stripe.error.InvalidRequestError:
+        # Not on the platform
+        return None
+    result['account_id'] = 'acct_1PsuX1Bq3IePH7QV'  # Platform account
+    result['account_name'] = 'LITFirst, LLC (Platform)'
+    fill_payment_details(result, payment)
+    return f"✓ Platform Account - ${payment.amount/100:.2f} {payment.currency.upper()}"
+
+def check_payment(payment_id, connected_accounts, platform_ids=None):
+    """
+    Find which account owns a payment, return (result row, progress message).
+    
+    If platform_ids is given, payments not in it are looked up on the connected
+    accounts first and only fall back to the platform (e.g. older payments).
+    """
+    result = {
+        'payment_id': payment_id,
+        'account_id': '',
+        'account_name': '',
+        'customer_name': '',
+        'event_name': '',
+        'amount': 0,
+        'currency': '',
+        'status': '',
+        'transaction_date_est': '',
+        'payout_status': '',
+        'payout_date': ''
+    }
+    
+    platform_first = platform_ids is None or payment_id in platform_ids
+    
+    # First, try platform account
+    if platform_first:
+        message = check_platform(payment_id, result)
+        if message:
+            return result, message
+    
+    # Try the connected accounts
+    account, payment = find_on_connected_accounts(payment_id, connected_accounts)
+    if account:
+        result['account_id'] = account['id']
+        result['account_name'] = account['name']
+        fill_payment_details(result, payment, stripe_account=account['id'])
+        return result, f"✓ Connected: {account['name']} - ${payment.amount/100:.2f}"
+    
+    # Not listed on the platform, but it may be older than the listed window
+    if not platform_first:
+        message = check_platform(payment_id, result)
+        if message:
+            return result, message
+    
+    result['account_name'] = 'NOT FOUND'
+    return result, "❌ Not found in any account"
+
 def main():
     print("\n" + "="*70)
     print("FINDING WHICH ACCOUNT OWNS EACH PAYMENT")
@@ -104,12 +297,13 @@ def main():
     accounts = stripe.Account.list(limit=100)
     connected_accounts = []
     
-    for account in accounts.data:
-        account_name = "Unknown"
-        if hasattr(account, 'business_profile') and account.business_profile:
-            account_name = getattr(account.business_profile, 'name', getattr(account, 'email', 'N/A'))
-        elif hasattr(account, 'email'):
-            account_name = account.email
+    # auto_paging_iter() keeps going past the first 100 accounts
+    for account in accounts.auto_paging_iter():
+        business_profile = getattr(account, 'business_profile', None)
+        if business_profile:
+            account_name = getattr(business_profile, 'name', getattr(account, 'email', 'N/A'))
+        else:
+            account_name = getattr(account, 'email', "Unknown")
         
         connected_accounts.append({
             'id': account.id,
@@ -118,113 +312,55 @@ def main():
     
     print(f"Found {len(connected_accounts)} connected accounts\n")
     
-    # Check which account owns each payment
-    results = []
+    # Rows are written as soon as they are ready, so an interrupted run
+    # can be resumed: payments already in the output file are skipped
+    account_totals = defaultdict(float)
+    existing = load_existing_results(OUTPUT_FILE)
+    wanted_ids = set(payment_ids)
+    for row in existing:
+        if row['payment_id'] in wanted_ids:
+            account_totals[row['account_name']] += float(row['amount'] or 0)
+    done_ids = {row['payment_id'] for row in existing}
+    pending_ids = [pid for pid in payment_ids if pid not in done_ids]
+    if existing:
+        print(f"Resuming: {len(payment_ids) - len(pending_ids)} payments already in {OUTPUT_FILE} "
+              f"(delete it to start over)\n")
     
-    for idx, payment_id in enumerate(payment_ids, 1):
-        print(f"[{idx}/{len(payment_ids)}] Checking {payment_id}...", end=' ')
-        
-        result = {
-            'payment_id': payment_id,
-            'account_id': '',
-            'account_name': '',
-            'customer_name': '',
-            'event_name': '',
-            'amount': 0,
-            'currency': '',
-            'status': '',
-            'transaction_date_est': '',
-            'payout_status': '',
-            'payout_date': ''
-        }
-        
-        # First, try platform account
-        try:
-            payment = stripe.PaymentIntent.retrieve(payment_id, expand=['latest_charge.balance_transaction'])
-            result['account_id'] = 'acct_1PsuX1Bq3IePH7QV'  # Platform account
-            result['account_name'] = 'LITFirst, LLC (Platform)'
-            result['amount'] = payment.amount / 100
-            result['currency'] = payment.currency.upper()
-            result['status'] = payment.status
-            
-            # Get transaction date in EST
-            if hasattr(payment, 'created'):
-                created_utc = datetime.fromtimestamp(payment.created, pytz.UTC)
-                created_est = created_utc.astimezone(EST)
-                result['transaction_date_est'] = created_est.strftime('%Y-%m-%d %H:%M:%S %Z')
-            
-            # Get customer name
-            if hasattr(payment, 'customer') and payment.customer:
-                result['customer_name'] = get_customer_name(payment.customer)
-            
-            # Get event name from metadata
-            if hasattr(payment, 'metadata') and payment.metadata:
-                result['event_name'] = payment.metadata.get('event', payment.metadata.get('event_name', payment.metadata.get('Event Name', '')))
-            
-            # Get payout status
-            if hasattr(payment, 'latest_charge') and payment.latest_charge:
-                charge = payment.latest_charge
-                if hasattr(charge, 'balance_transaction') and charge.balance_transaction:
-                    payout_status, payout_date = get_payout_status(charge.balance_transaction)
-                    result['payout_status'] = payout_status
-                    result['payout_date'] = payout_date
-            
-            print(f"✓ Platform Account - ${payment.amount/100:.2f} {payment.currency.upper()}")
-            results.append(result)
-            continue
-        except:
-            pass
-        
-        # Try each connected account
-        found = False
-        for account in connected_accounts:
-            success, payment = check_payment_on_connected_account(payment_id, account['id'])
-            if success:
-                result['account_id'] = account['id']
-                result['account_name'] = account['name']
-                result['amount'] = payment.amount / 100
-                result['currency'] = payment.currency.upper()
-                result['status'] = payment.status
-                
-                # Get transaction date in EST
-                if hasattr(payment, 'created'):
-                    created_utc = datetime.fromtimestamp(payment.created, pytz.UTC)
-                    created_est = created_utc.astimezone(EST)
-                    result['transaction_date_est'] = created_est.strftime('%Y-%m-%d %H:%M:%S %Z')
-                
-                # Get customer name
-                if hasattr(payment, 'customer') and payment.customer:
-                    result['customer_name'] = get_customer_name(payment.customer, stripe_account=account['id'])
-                
-                # Get event name from metadata
-                if hasattr(payment, 'metadata') and payment.metadata:
-                    result['event_name'] = payment.metadata.get('event', payment.metadata.get('event_name', payment.metadata.get('Event Name', '')))
-                
-                # Get payout status
-                if hasattr(payment, 'latest_charge') and payment.latest_charge:
-                    charge = payment.latest_charge
-                    if hasattr(charge, 'balance_transaction') and charge.balance_transaction:
-                        payout_status, payout_date = get_payout_status(charge.balance_transaction, stripe_account=account['id'])
-                        result['payout_status'] = payout_status
-                        result['payout_date'] = payout_date
-                
-                print(f"✓ Connected: {account['name']} - ${payment.amount/100:.2f}")
-                found = True
-                break
-        
-        if not found:
-            result['account_name'] = 'NOT FOUND'
-            print("❌ Not found in any account")
-        
-        results.append(result)
+    # One paged list replaces a platform lookup per payment, as long as it
+    # needs far fewer list calls than there are payments left to look up
+    platform_ids = None
+    if pending_ids:
+        print(f"Listing platform payments from the last {PLATFORM_LOOKBACK_DAYS} days...")
+        platform_ids = load_platform_payment_ids(PLATFORM_LOOKBACK_DAYS,
+                                                 max_pages=max(1, len(pending_ids) // 10))
+        if platform_ids is None:
+            print("Too many to list, trying the platform first for every payment\n")
+        else:
+            print(f"Found {len(platform_ids)} platform payments\n")
+    
+    lock = threading.Lock()
+    done = 0
     
-    # Save results to CSV
-    with open(OUTPUT_FILE, 'w', newline='') as csvfile:
-        fieldnames = ['payment_id', 'account_id', 'account_name', 'customer_name', 'event_name', 
-                      'amount', 'currency', 'status', 'transaction_date_est', 'payout_status', 'payout_date']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(results)
+    def process(payment_id):
+        """Resolve one payment, print progress under the lock so lines don't interleave"""
+        nonlocal done
+        result, message = check_payment(payment_id, connected_accounts, platform_ids)
+        with lock:
+            done += 1
+            print(f"[{done}/{len(pending_ids)}] {payment_id} {message}")
+        return result
+    
+    # Check which account owns each payment, rows are written in input order
+    with open(OUTPUT_FILE, 'a' if existing else 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=FIELDNAMES)
+        if not existing:
+            writer.writeheader()
+        
+        with ThreadPoolExecutor(max_workers=PAYMENT_WORKERS) as executor:
+            for result in executor.map(process, pending_ids):
+                writer.writerow(result)
+                csvfile.flush()
+                account_totals[result['account_name']] += result['amount']
     
     print(f"\n✓ Results saved to {OUTPUT_FILE}")
     
@@ -233,12 +369,6 @@ def main():
     print("SUMMARY")
     print(f"{'='*70}\n")
     
-    account_totals = {}
-    for result in results:
-        if result['account_name'] not in account_totals:
-            account_totals[result['account_name']] = 0
-        account_totals[result['account_name']] += result['amount']
-    
     for account_name, total in sorted(account_totals.items(), key=lambda x: x[1], reverse=True):
         print(f"{account_name}: ${total:,.2f}")
     
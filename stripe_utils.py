@@ -0,0 +1,263 @@
+"""
+Shared Stripe helpers for the reconciliation scripts
+"""
+
+import functools
+import json
+import os
+import random
+import requests
+import sqlite3
+import stripe
+import threading
+import time
+from requests.adapters import HTTPAdapter
+
+# Stripe allows 100 requests/second in live mode, keep some headroom
+STRIPE_REQUESTS_PER_SECOND = 80
+SLOW_DOWN_SECONDS = 30  # Run at half rate this long after a 429
+HTTP_TIMEOUT = 20  # Seconds per Stripe request
+
+# Retry transient errors (429, 5xx, network) instead of treating them as "not found"
+RETRY_ATTEMPTS = 6
+RETRY_INITIAL_WAIT = 0.5  # Seconds, doubled on each attempt
+RETRY_MAX_WAIT = 30
+
+# Payout info per balance transaction, shared by both scripts across runs
+BT_CACHE_FILE = 'stripe_cache.sqlite'
+BT_CACHE_TTL = 3600  # Seconds
+
+# Retrieved PaymentIntents, so the Excel updater reuses what find_payment_accounts.py fetched
+PI_CACHE_DIR = '.cache'
+PI_CACHE_TTL = 3600  # Seconds
+
+RETRYABLE_ERRORS = (
+    stripe.error.RateLimitError,
+    stripe.error.APIConnectionError,
+    stripe.error.APIError,
+)
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all threads: at most `rate` requests per second.
+    
+    After slow_down() the rate is halved for SLOW_DOWN_SECONDS.
+    """
+    
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated_at = time.monotonic()
+        self.slowed_until = 0.0
+        self.lock = threading.Lock()
+    
+    def slow_down(self):
+        """Halve the rate for a while, called when Stripe answers with a 429"""
+        with self.lock:
+            self.slowed_until = time.monotonic() + SLOW_DOWN_SECONDS
+    
+    def acquire(self):
+        """Block until a request may be sent"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                rate = self.rate / 2 if now < self.slowed_until else self.rate
+                self.tokens = min(rate, self.tokens + (now - self.updated_at) * rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / rate
+            time.sleep(wait)
+
+
+limiter = RateLimiter(STRIPE_REQUESTS_PER_SECOND)
+
+
+class RateLimitedRequestsClient(stripe.RequestsClient):
+    """Stripe HTTP client that waits for the rate limiter before every request"""
+    
+    def __init__(self, limiter, **kwargs):
+        super().__init__(**kwargs)
+        self.limiter = limiter
+    
+    def request(self, method, url, headers, post_data=None):
+        self.limiter.acquire()
+        return super().request(method, url, headers, post_data)
+
+
+def install_http_client():
+    """
+    Send all Stripe API calls of this process through one shared, rate-limited
+    connection pool, so worker threads reuse TLS connections instead of each
+    opening their own.
+    """
+    session = requests.Session()
+    # Stripe and retry_stripe already retry, don't let urllib3 retry as well
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=0)
+    session.mount('https://', adapter)
+    stripe.default_http_client = RateLimitedRequestsClient(
+        limiter, session=session, timeout=HTTP_TIMEOUT
+    )
+
+
+def retry_stripe(func):
+    """Retry func on RETRYABLE_ERRORS with exponential backoff and jitter"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(1, RETRY_ATTEMPTS + 1):
+            try:
+                return func(*args, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                if isinstance(e, stripe.error.RateLimitError):
+                    limiter.slow_down()
+                if attempt == RETRY_ATTEMPTS:
+                    raise
+                wait = min(RETRY_MAX_WAIT, RETRY_INITIAL_WAIT * 2 ** (attempt - 1))
+                time.sleep(wait + random.uniform(0, 1))
+    return wrapper
+
+
+def _payment_cache_path(payment_id):
+    """Cache file of a payment, or None if the ID isn't safe to use as a file name"""
+    if not payment_id.replace('_', '').isalnum():
+        return None
+    return os.path.join(PI_CACHE_DIR, f'{payment_id}.json')
+
+
+def load_cached_payment(payment_id, stripe_account=None):
+    """Return the cached PaymentIntent if it is fresh and was found in stripe_account, else None"""
+    path = _payment_cache_path(payment_id)
+    if path is None:
+        return None
+    try:
+        if time.time() - os.path.getmtime(path) > PI_CACHE_TTL:
+            return None
+        with open(path, 'r') as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if entry.get('stripe_account') != stripe_account:
+        return None
+    # Rebuilds the nested objects too, so expanded fields work as usual
+    return stripe.PaymentIntent.construct_from(
+        entry['payment'], stripe.api_key, stripe_account=stripe_account
+    )
+
+
+def save_cached_payment(payment, stripe_account=None):
+    """Write a PaymentIntent (with its expansions) to the cache directory"""
+    path = _payment_cache_path(payment.id)
+    if path is None:
+        return
+    os.makedirs(PI_CACHE_DIR, exist_ok=True)
+    entry = {'stripe_account': stripe_account, 'payment': payment.to_dict(for_json=True)}
+    # Write to a temporary file first so readers never see a partial file
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def sweep_payment_cache():
+    """Delete cached PaymentIntents older than PI_CACHE_TTL"""
+    try:
+        names = os.listdir(PI_CACHE_DIR)
+    except FileNotFoundError:
+        return
+    cutoff = time.time() - PI_CACHE_TTL
+    for name in names:
+        path = os.path.join(PI_CACHE_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+@retry_stripe
+def retrieve_payment(payment_id, stripe_account=None, read_cache=True):
+    """
+    Retrieve a PaymentIntent with its balance transaction expanded.
+    
+    The result is always written to the on-disk cache (see PI_CACHE_DIR), and
+    read from it first unless read_cache is False.
+    Raises stripe.error.InvalidRequestError if the account doesn't own the payment.
+    """
+    if read_cache:
+        payment = load_cached_payment(payment_id, stripe_account)
+        if payment is not None:
+            return payment
+    
+    payment = stripe.PaymentIntent.retrieve(
+        payment_id,
+        stripe_account=stripe_account,
+        expand=['latest_charge.balance_transaction']
+    )
+    save_cached_payment(payment, stripe_account)
+    return payment
+
+
+class BalanceTransactionCache:
+    """
+    balance_transaction.id -> (payout_id, bank_account, deposit_date, payout_status),
+    kept in an SQLite file so the Excel updater and find_payment_accounts.py share it.
+    
+    The last entry read or written is also kept in memory, and entries older
+    than BT_CACHE_TTL are swept when the file is opened.
+    """
+    
+    def __init__(self, filename=BT_CACHE_FILE):
+        self.filename = filename
+        self.conn = None
+        self.last = (None, None)  # (bt_id, value)
+        self.lock = threading.Lock()
+    
+    def _connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+            # Older files have a payouts table without the payout status
+            self.conn.execute('DROP TABLE IF EXISTS payouts')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS bt_payouts ('
+                'bt_id TEXT PRIMARY KEY, payout_id TEXT, bank_account TEXT, '
+                'deposit_date TEXT, payout_status TEXT, cached_at REAL)'
+            )
+            self.conn.execute('DELETE FROM bt_payouts WHERE cached_at < ?', (time.time() - BT_CACHE_TTL,))
+            self.conn.commit()
+        return self.conn
+    
+    def get(self, bt_id):
+        """Return (payout_id, bank_account, deposit_date, payout_status) or None"""
+        with self.lock:
+            if self.last[0] == bt_id:
+                return self.last[1]
+            row = self._connect().execute(
+                'SELECT payout_id, bank_account, deposit_date, payout_status FROM bt_payouts '
+                'WHERE bt_id = ? AND cached_at >= ?',
+                (bt_id, time.time() - BT_CACHE_TTL)
+            ).fetchone()
+            if row:
+                self.last = (bt_id, row)
+            return row
+    
+    def put(self, bt_id, payout_id, bank_account, deposit_date, payout_status):
+        with self.lock:
+            conn = self._connect()
+            conn.execute(
+                'INSERT OR REPLACE INTO bt_payouts VALUES (?, ?, ?, ?, ?, ?)',
+                (bt_id, payout_id, bank_account, deposit_date, payout_status, time.time())
+            )
+            conn.commit()
+            self.last = (bt_id, (payout_id, bank_account, deposit_date, payout_status))
+
+
+bt_cache = BalanceTransactionCache()
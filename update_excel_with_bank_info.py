@@ -10,12 +10,31 @@ import os
 from datetime import datetime
 import pytz
 import time
+from bisect import bisect_left, bisect_right
+
+from stripe_utils import (bt_cache, install_http_client, retrieve_payment, retry_stripe,
+                          sweep_payment_cache)
 
 # Configuration
 MAPPING_FILE = 'payment_account_mapping.csv'
 EXCEL_FILE = 'All-Events-2025-11-13T04-41-45-385Z.xlsx'
 OUTPUT_FILE = 'Deposit Breakdown - Updated.xlsx'
 STRIPE_API_KEY = os.environ.get('STRIPE_SECRET_KEY', '')
+PAYMENT_ID_COLUMN = os.environ.get('PAYMENT_ID_COLUMN', 'Payment Intent ID')
+NEW_COLUMNS = ['Stripe Account Name', 'Transfer/Payout ID', 'Bank Account', 'Bank Deposit Date']
+CACHE_TTL = 3600  # Seconds to trust cached bank accounts
+
+# Bank accounts rarely change, so look each one up once per run
+# account_id -> (default bank account, cached_at)
+_account_default_bank_cache = {}
+# (account_id, external_account_id) -> (bank account, cached_at)
+_bank_cache = {}
+
+# Payouts are fetched once per account and reused for all of its payments
+PAYOUT_CACHE_TTL = 600  # Seconds, new payouts show up a few times a day
+PAYOUT_WINDOW = 86400 * 3  # Payout must arrive within 3 days of the available date
+# account_id -> ((arrival_dates, payouts) sorted by arrival_date, cached_at)
+_payouts_by_account = {}
 
 # Timezone
 EST = pytz.timezone('America/New_York')
@@ -26,6 +45,8 @@ def setup_stripe():
         print("WARNING: STRIPE_SECRET_KEY not set. Bank and transfer info will not be fetched.")
         return False
     stripe.api_key = STRIPE_API_KEY
+    install_http_client()
+    sweep_payment_cache()
     return True
 
 def load_payment_mapping(filename):
@@ -40,102 +61,175 @@ def load_payment_mapping(filename):
             }
     return payment_mapping
 
+def _get_cached(cache, key, ttl=CACHE_TTL):
+    """Return a cached value that is younger than ttl seconds, or None"""
+    cached = cache.get(key)
+    if cached and time.monotonic() - cached[1] < ttl:
+        return cached[0]
+    return None
+
+def format_bank_account(bank):
+    """Format a bank account as 'BANK NAME •••• 1234'"""
+    bank_name = getattr(bank, 'bank_name', None)
+    if bank_name is None:
+        return ''
+    last4 = getattr(bank, 'last4', '****')
+    return f"{bank_name} •••• {last4}"
+
+@retry_stripe
+def get_payout_bank_account(account_id, destination):
+    """Get the bank account a payout was sent to"""
+    key = (account_id, destination)
+    bank_account = _get_cached(_bank_cache, key)
+    if bank_account is not None:
+        return bank_account
+    
+    try:
+        if account_id and account_id != 'acct_1PsuX1Bq3IePH7QV':
+            bank = stripe.Account.retrieve_external_account(
+                account_id,
+                destination
+            )
+        else:
+            acct = stripe.Account.retrieve()
+            bank = stripe.Account.retrieve_external_account(
+                acct.id,
+                destination
+            )
+        bank_account = format_bank_account(bank)
+    except (stripe.error.InvalidRequestError, stripe.error.PermissionError):
+        return ''
+    
+    _bank_cache[key] = (bank_account, time.monotonic())
+    return bank_account
+
+@retry_stripe
+def get_default_bank_account(account_id):
+    """Get the default bank account of an account"""
+    bank_account = _get_cached(_account_default_bank_cache, account_id)
+    if bank_account is not None:
+        return bank_account
+    
+    try:
+        if account_id and account_id != 'acct_1PsuX1Bq3IePH7QV':
+            account = stripe.Account.retrieve(account_id)
+            external_accounts = account.external_accounts.list(limit=1)
+        else:
+            account = stripe.Account.retrieve()
+            external_accounts = account.external_accounts.list(limit=1)
+        
+        bank_account = ''
+        if external_accounts.data:
+            bank_account = format_bank_account(external_accounts.data[0])
+    except (stripe.error.InvalidRequestError, stripe.error.PermissionError):
+        return ''
+    
+    _account_default_bank_cache[account_id] = (bank_account, time.monotonic())
+    return bank_account
+
+@retry_stripe
+def get_account_payouts(account_id):
+    """Get all payouts of an account as (arrival_dates, payouts), sorted by arrival date"""
+    payouts = _get_cached(_payouts_by_account, account_id, PAYOUT_CACHE_TTL)
+    if payouts is not None:
+        return payouts
+    
+    if account_id and account_id != 'acct_1PsuX1Bq3IePH7QV':
+        payout_list = stripe.Payout.list(limit=100, stripe_account=account_id)
+    else:
+        payout_list = stripe.Payout.list(limit=100)
+    
+    sorted_payouts = sorted(
+        (p for p in payout_list.auto_paging_iter() if getattr(p, 'arrival_date', None)),
+        key=lambda p: p.arrival_date
+    )
+    payouts = ([p.arrival_date for p in sorted_payouts], sorted_payouts)
+    _payouts_by_account[account_id] = (payouts, time.monotonic())
+    return payouts
+
+def find_payout(account_id, available_on):
+    """Find the latest payout arriving within PAYOUT_WINDOW of available_on"""
+    arrival_dates, payouts = get_account_payouts(account_id)
+    lo = bisect_left(arrival_dates, available_on - PAYOUT_WINDOW)
+    hi = bisect_right(arrival_dates, available_on + PAYOUT_WINDOW)
+    if lo < hi:
+        return payouts[hi - 1]
+    return None
+
 def get_bank_and_transfer_info(payment_id, account_id):
     """Get transfer ID, bank account, and deposit date for a payment"""
     try:
         # Retrieve payment intent with expanded balance transaction
         if account_id and account_id != 'acct_1PsuX1Bq3IePH7QV':
-            payment = stripe.PaymentIntent.retrieve(
-                payment_id,
-                stripe_account=account_id,
-                expand=['latest_charge.balance_transaction']
-            )
+            payment = retrieve_payment(payment_id, stripe_account=account_id)
         else:
-            payment = stripe.PaymentIntent.retrieve(
-                payment_id,
-                expand=['latest_charge.balance_transaction']
-            )
+            payment = retrieve_payment(payment_id)
         
         transfer_id = ''
         bank_account = ''
         deposit_date = ''
+        payout_status = None
         
         # Get balance transaction info
-        if hasattr(payment, 'latest_charge') and payment.latest_charge:
-            charge = payment.latest_charge
-            if hasattr(charge, 'balance_transaction') and charge.balance_transaction:
-                bt = charge.balance_transaction
+        charge = getattr(payment, 'latest_charge', None)
+        bt = getattr(charge, 'balance_transaction', None) if charge else None
+        if bt:
+            # Payout already resolved by an earlier run
+            cached = bt_cache.get(bt.id)
+            if cached:
+                return cached[:3]
+            
+            # Get available date (when funds became available)
+            available_on = getattr(bt, 'available_on', None)
+            if available_on:
+                deposit_date_obj = datetime.fromtimestamp(available_on, EST)
+                deposit_date = deposit_date_obj.strftime('%Y-%m-%d')
+            
+            # Try to find payout information
+            try:
+                payout = None
+                if available_on:
+                    payout = find_payout(account_id, available_on)
                 
-                # Get available date (when funds became available)
-                if hasattr(bt, 'available_on') and bt.available_on:
-                    deposit_date_obj = datetime.fromtimestamp(bt.available_on, EST)
+                if payout:
+                    transfer_id = payout.id
+                    payout_status = getattr(payout, 'status', None)
+                    # Update deposit date with actual payout date
+                    deposit_date_obj = datetime.fromtimestamp(payout.arrival_date, EST)
                     deposit_date = deposit_date_obj.strftime('%Y-%m-%d')
-                
-                # Try to find payout information
-                try:
-                    if account_id and account_id != 'acct_1PsuX1Bq3IePH7QV':
-                        payouts = stripe.Payout.list(limit=20, stripe_account=account_id)
-                    else:
-                        payouts = stripe.Payout.list(limit=20)
                     
-                    # Look for a payout that includes this balance transaction
-                    for payout in payouts.data:
-                        if hasattr(payout, 'arrival_date') and hasattr(bt, 'available_on'):
-                            # If payout arrival is within 3 days of available date
-                            if abs(payout.arrival_date - bt.available_on) <= 86400 * 3:
-                                transfer_id = payout.id
-                                # Update deposit date with actual payout date
-                                deposit_date_obj = datetime.fromtimestamp(payout.arrival_date, EST)
-                                deposit_date = deposit_date_obj.strftime('%Y-%m-%d')
-                                
-                                # Get bank account from payout
-                                if hasattr(payout, 'destination') and payout.destination:
-                                    try:
-                                        if account_id and account_id != 'acct_1PsuX1Bq3IePH7QV':
-                                            bank = stripe.Account.retrieve_external_account(
-                                                account_id,
-                                                payout.destination
-                                            )
-                                        else:
-                                            acct = stripe.Account.retrieve()
-                                            bank = stripe.Account.retrieve_external_account(
-                                                acct.id,
-                                                payout.destination
-                                            )
-                                        
-                                        if hasattr(bank, 'bank_name'):
-                                            bank_name = bank.bank_name
-                                            last4 = getattr(bank, 'last4', '****')
-                                            bank_account = f"{bank_name} •••• {last4}"
-                                    except:
-                                        pass
-                                break
-                except:
-                    pass
-                
-                # If no payout found, try to get default bank account
-                if not bank_account:
-                    try:
-                        if account_id and account_id != 'acct_1PsuX1Bq3IePH7QV':
-                            account = stripe.Account.retrieve(account_id)
-                            external_accounts = account.external_accounts.list(limit=1)
-                        else:
-                            account = stripe.Account.retrieve()
-                            external_accounts = account.external_accounts.list(limit=1)
-                        
-                        if external_accounts.data:
-                            bank = external_accounts.data[0]
-                            if hasattr(bank, 'bank_name'):
-                                bank_name = bank.bank_name
-                                last4 = getattr(bank, 'last4', '****')
-                                bank_account = f"{bank_name} •••• {last4}"
-                    except:
-                        pass
-        
+                    # Get bank account from payout
+                    destination = getattr(payout, 'destination', None)
+                    if destination:
+                        bank_account = get_payout_bank_account(account_id, destination)
+            except (stripe.error.InvalidRequestError, stripe.error.PermissionError):
+                pass
+            
+            # If no payout found, try to get default bank account
+            if not bank_account:
+                bank_account = get_default_bank_account(account_id)
+            
+            # Pending or in-transit payouts can still fail or move, only
+            # remember the ones that reached the bank
+            if transfer_id and payout_status == 'paid':
+                bt_cache.put(bt.id, transfer_id, bank_account, deposit_date, payout_status)
+    
         return transfer_id, bank_account, deposit_date
-    except Exception as e:
+    except (stripe.error.InvalidRequestError, stripe.error.PermissionError):
         return '', '', ''
 
+def find_payment_id_column(df):
+    """Use PAYMENT_ID_COLUMN if present, else the first text column that is mostly pi_ values"""
+    if PAYMENT_ID_COLUMN in df.columns:
+        return PAYMENT_ID_COLUMN
+    
+    for col in df.select_dtypes(include=['object', 'string']).columns:
+        values = df[col].dropna().astype(str).str.strip()
+        values = values[values != '']
+        if len(values) and values.str.startswith('pi_').mean() > 0.5:
+            return col
+    return None
+
 def main():
     print("="*70)
     print("UPDATING EXCEL FILE WITH BANK DEPOSIT INFORMATION")
@@ -149,61 +243,55 @@ def main():
     print(f"Loaded {len(payment_mapping)} payment mappings\n")
     
     # Read the Excel file
-    df = pd.read_excel(EXCEL_FILE)
+    df = pd.read_excel(EXCEL_FILE, engine='calamine')
     print(f"Excel file has {len(df)} rows and {len(df.columns)} columns\n")
     
     # Find the payment ID column
-    payment_id_column = None
-    for col in df.columns:
-        sample_values = df[col].astype(str).head(10)
-        if any('pi_' in str(val) for val in sample_values):
-            print(f"Found payment IDs in column: '{col}'")
-            payment_id_column = col
-            break
-    
+    payment_id_column = find_payment_id_column(df)
     if not payment_id_column:
         print("❌ Could not find a column with payment IDs")
         return
+    print(f"Found payment IDs in column: '{payment_id_column}'")
     
-    # Create new columns
-    df['Stripe Account Name'] = ''
-    df['Transfer/Payout ID'] = ''
-    df['Bank Account'] = ''
-    df['Bank Deposit Date'] = ''
-    
-    # Process each row
+    # Look up each payment once, even if it appears on several rows
     print(f"\nProcessing {len(df)} rows...\n")
     
+    payment_ids = df[payment_id_column].fillna('').astype(str).str.strip()
+    enrichment = {}  # payment_id -> {new column: value}
     processed_count = 0
-    for idx, row in df.iterrows():
-        payment_id = str(row[payment_id_column]).strip()
+    for payment_id in payment_ids.unique():
+        if not (payment_id.startswith('pi_') and payment_id in payment_mapping):
+            continue
         
-        if pd.notna(row[payment_id_column]) and payment_id.startswith('pi_'):
-            if payment_id in payment_mapping:
-                # Get account name
-                account_name = payment_mapping[payment_id]['account_name']
-                account_id = payment_mapping[payment_id]['account_id']
-                df.at[idx, 'Stripe Account Name'] = account_name
-                
-                # Get bank and transfer info if Stripe is enabled
-                if stripe_enabled and account_name != 'NOT FOUND':
-                    transfer_id, bank_account, deposit_date = get_bank_and_transfer_info(payment_id, account_id)
-                    
-                    if transfer_id:
-                        df.at[idx, 'Transfer/Payout ID'] = transfer_id
-                    if bank_account:
-                        df.at[idx, 'Bank Account'] = bank_account
-                    if deposit_date:
-                        df.at[idx, 'Bank Deposit Date'] = deposit_date
-                    
-                    processed_count += 1
-                    print(f"[{processed_count}/{len(payment_mapping)}] {payment_id} → {account_name} → {bank_account} (Deposited: {deposit_date})")
-                    time.sleep(0.1)  # Rate limiting
-                else:
-                    print(f"[{idx+1}] {payment_id} → {account_name} (Stripe API not available)")
+        # Get account name
+        account_name = payment_mapping[payment_id]['account_name']
+        account_id = payment_mapping[payment_id]['account_id']
+        transfer_id, bank_account, deposit_date = '', '', ''
+        
+        # Get bank and transfer info if Stripe is enabled
+        if stripe_enabled and account_name != 'NOT FOUND':
+            transfer_id, bank_account, deposit_date = get_bank_and_transfer_info(payment_id, account_id)
+            processed_count += 1
+            print(f"[{processed_count}/{len(payment_mapping)}] {payment_id} → {account_name} → {bank_account} (Deposited: {deposit_date})")
+        else:
+            print(f"{payment_id} → {account_name} (Stripe API not available)")
+        
+        enrichment[payment_id] = {
+            'Stripe Account Name': account_name,
+            'Transfer/Payout ID': transfer_id,
+            'Bank Account': bank_account,
+            'Bank Deposit Date': deposit_date,
+        }
+    
+    # Fill the new columns in one pass each
+    for column in NEW_COLUMNS:
+        df[column] = payment_ids.map(lambda pid: enrichment.get(pid, {}).get(column, ''))
     
     # Save updated Excel file
-    df.to_excel(OUTPUT_FILE, index=False)
+    # xlsxwriter only writes, which makes it faster than openpyxl. Its
+    # constant_memory mode can't be used: pandas writes column by column,
+    # and constant_memory drops cells of rows it already flushed
+    df.to_excel(OUTPUT_FILE, index=False, engine='xlsxwriter')
     print(f"\n✓ Updated Excel file saved as: {OUTPUT_FILE}\n")
     
     # Summary